@@ -33,6 +33,9 @@ calls these functions:
 
 Note that this module is executed by Sublime Text's internal Python
 interpreter, so you should not try to import from your code in __testgen__.py.
+The chain of __testgen__.py modules is executed once and the resulting
+functions are reused until one of the modules changes, so the functions
+should not rely on module-level state being reset between calls.
 Also, avoid reading directly from source_filename since the file contents
 may be out of sync with the current Sublime Text buffer.
 """
@@ -1,5 +1,8 @@
 
+import array
 import ast
+import bisect
+import collections
 import os
 import re
 import sublime
@@ -23,6 +26,8 @@ except NameError:
 
 empty_line_re = re.compile(r'\s*$')
 _deferred = {}  # {filename: CodeNavigator}
+_snapshots = {}  # {filename: (DeclSnapshot, ...)}
+_testgen_cache = {}  # {(modfile, ...): ((stamp, ...), {func_name: func})}
 here = os.path.abspath(os.path.dirname(__file__))
 
 
@@ -94,6 +99,8 @@ class Visitor(ast.NodeVisitor):
         self.close_decls(node.lineno)
         self.visitdecl(node, FuncDecl)
 
+    visit_AsyncFunctionDef = visit_FunctionDef
+
     def visit_ClassDef(self, node):
         self.close_decls(node.lineno)
         self.visitdecl(node, ClassDecl)
@@ -148,10 +155,68 @@ def find_decl_for_row(decls, row):
     return None
 
 
+def find_path_for_row(decls, row):
+    """List the nested decls that contain a row, outermost first.
+
+    Unlike Decl.get_path(), this works for DeclSnapshots too.
+    """
+    path = []
+    while decls:
+        for decl in decls:
+            if row >= decl.first_row and row <= decl.last_row:
+                path.append(decl)
+                decls = decl.children
+                break
+        else:
+            break
+    return path
+
+
+DeclSnapshot = collections.namedtuple(
+    'DeclSnapshot', ['kind', 'name', 'first_row', 'last_row', 'children'])
+
+
+def freeze_decls(decls, previous=()):
+    """Convert a list of Decls to a tuple of immutable DeclSnapshots.
+
+    Snapshots are plain tuples, so they can be shared between threads and
+    handed to many consumers without copying. Subtrees that are unchanged
+    from the previous snapshot are reused rather than rebuilt.
+
+    Note that subtrees are matched by their absolute rows, so an edit that
+    adds or removes lines prevents reuse of everything below it.
+    """
+    shared = {}
+    stack = list(previous)
+    while stack:
+        snapshot = stack.pop()
+        shared[snapshot] = snapshot
+        stack.extend(snapshot.children)
+    return _freeze_decls(decls, shared)
+
+
+def _freeze_decls(decls, shared):
+    snapshots = []
+    for decl in decls:
+        snapshot = DeclSnapshot(decl.__class__,
+                                decl.name,
+                                decl.first_row,
+                                decl.last_row,
+                                _freeze_decls(decl.children, shared))
+        snapshots.append(shared.get(snapshot, snapshot))
+    return tuple(snapshots)
+
+
+def list_decl_snapshots(content, filename, previous=()):
+    """List the nested declarations in a module as DeclSnapshots."""
+    return freeze_decls(list_decls(content, filename), previous)
+
+
 class GotoTestCommand(sublime_plugin.TextCommand):
     """Go to the unit test for this Python code or vice-versa"""
 
     generate = False
+    related = False
 
     def run(self, edit):
         view = self.view
@@ -186,7 +251,8 @@ class GotoTestCommand(sublime_plugin.TextCommand):
                     nav = MainCodeNavigator(target_filename=target,
                                             source_filename=fname,
                                             content=content,
-                                            source_row=row)
+                                            source_row=row,
+                                            related=self.related)
                 except SyntaxError as e:
                     show_syntax_error(e)
                     return
@@ -213,19 +279,28 @@ class GotoTestCommand(sublime_plugin.TextCommand):
                                         source_filename=fname,
                                         content=content,
                                         source_row=row,
-                                        generate=self.generate)
+                                        generate=self.generate,
+                                        related=self.related)
             except SyntaxError as e:
                 show_syntax_error(e)
                 return
 
-            if not os.path.exists(parent):
-                os.mkdir(parent)
+            if not self.related:
+                # Create the tests package. (Listing related tests only
+                # reads existing files.)
+                if not os.path.exists(parent):
+                    os.mkdir(parent)
 
-            init_py = os.path.join(parent, '__init__.py')
-            if not os.path.exists(init_py):
-                # Create an empty __init__.py in the tests subdir.
-                f = open(init_py, 'w')
-                f.close()
+                init_py = os.path.join(parent, '__init__.py')
+                if not os.path.exists(init_py):
+                    # Create an empty __init__.py in the tests subdir.
+                    f = open(init_py, 'w')
+                    f.close()
+
+        if self.related and not os.path.exists(target):
+            sublime.status_message("SublimePythonGotoTest: "
+                                   "{0} does not exist.".format(target))
+            return
 
         win = view.window()
         view = win.open_file(target)
@@ -241,6 +316,11 @@ class GenerateTestCommand(GotoTestCommand):
     generate = True
 
 
+class GotoRelatedCommand(GotoTestCommand):
+    """List all the related tests (or code under test) in a quick panel"""
+    related = True
+
+
 class Listener(sublime_plugin.EventListener):
     """Finish test generation right after a test module has been opened."""
     def on_load(self, view):
@@ -269,9 +349,145 @@ def to_main_name(name):
         return None
 
 
-def show_rows(view, first_row, last_row):
+class DeclNameIndex(object):
+    """A sorted index of class and method declarations by dotted name.
+
+    The index is built once per parse so that related names can be found
+    with a binary search instead of a scan over every declaration.
+    """
+
+    def __init__(self, decls, to_class_name=None, to_method_name=None):
+        pairs = []
+        for decl in decls:
+            name = decl.name
+            if to_class_name is not None:
+                name = to_class_name(name)
+            pairs.append((name, decl))
+            if isinstance(decl, ClassDecl):
+                for child in decl.children:
+                    if isinstance(child, FuncDecl):
+                        child_name = child.name
+                        if to_method_name is not None:
+                            child_name = to_method_name(child_name)
+                        pairs.append((name + '.' + child_name, child))
+        pairs.sort(key=lambda pair: pair[0])
+        self.keys = [key for key, _decl in pairs]
+        self.decls = [decl for _key, decl in pairs]
+
+    def exact(self, name):
+        """List the decls with the given name."""
+        start = bisect.bisect_left(self.keys, name)
+        end = bisect.bisect_right(self.keys, name, start)
+        return list(zip(self.keys[start:end], self.decls[start:end]))
+
+    def prefix_under(self, name):
+        """List the decls named 'name' or starting with 'name_'.
+
+        Only names at the same depth as 'name' are listed, so the methods
+        of a class named 'name_other' are not included.
+        """
+        # '`' is the character that sorts immediately after '_'.
+        start = bisect.bisect_left(self.keys, name + '_')
+        end = bisect.bisect_left(self.keys, name + '`', start)
+        size = len(name)
+        return self.exact(name) + [
+            (key, decl)
+            for key, decl in zip(self.keys[start:end], self.decls[start:end])
+            if '.' not in key[size:]]
+
+    def related(self, name):
+        """List the decls named by 'name' or by a prefix of 'name'.
+
+        Prefixes end at an underscore or a dot, so 'Test_foo.test_bar_baz'
+        is related to 'Test_foo.test_bar' and 'Test_foo'. The longest
+        matches are listed first.
+        """
+        matches = []
+        end = len(name)
+        while end > 0:
+            matches.extend(self.exact(name[:end]))
+            end = max(name.rfind('_', 0, end), name.rfind('.', 0, end))
+        return matches
+
+
+def show_related(view, matches):
+    """Show a quick panel listing (name, decl) pairs in a view."""
+    if not matches:
+        sublime.status_message("SublimePythonGotoTest: "
+                               "No related code found.")
+        return
+
+    items = [[name, 'line {0}'.format(decl.first_row + 1)]
+             for name, decl in matches]
+
+    def on_done(index):
+        if index >= 0:
+            _name, decl = matches[index]
+            show_rows(view, decl.first_row, decl.last_row)
+
+    view.window().show_quick_panel(items, on_done)
+
+
+class ViewText(object):
+    """A snapshot of a buffer's text with a table of line start offsets.
+
+    Computing points and blank lines from the snapshot avoids a round trip
+    to the view for every query.
+    """
+
+    def __init__(self, content):
+        self.content = content
+        line_starts = array.array('l', [0])
+        find = content.find
+        pos = find('\n')
+        while pos >= 0:
+            line_starts.append(pos + 1)
+            pos = find('\n', pos + 1)
+        self.line_starts = line_starts
+
+    def size(self):
+        return len(self.content)
+
+    def last_row(self):
+        """Get the row of the end of the buffer."""
+        return len(self.line_starts) - 1
+
+    def text_point(self, row):
+        """Get the point at the start of a row, like view.text_point()."""
+        if row >= len(self.line_starts):
+            return len(self.content)
+        return self.line_starts[max(0, row)]
+
+    def newlines_before(self, point, limit):
+        """Count the newlines immediately before a point, up to a limit."""
+        content = self.content
+        count = 0
+        while (count < limit and point - count > 0 and
+               content[point - count - 1] == '\n'):
+            count += 1
+        return count
+
+    def newlines_after(self, point, limit):
+        """Count the newlines immediately after a point, up to a limit."""
+        content = self.content
+        size = len(content)
+        count = 0
+        while (count < limit and point + count < size and
+               content[point + count] == '\n'):
+            count += 1
+        return count
+
+
+def view_text(view):
+    return ViewText(view.substr(sublime.Region(0, view.size())))
+
+
+def show_rows(view, first_row, last_row, text=None):
     """Position the cursor within a range of rows in a view."""
-    first_point = view.text_point(first_row, 0)
+    if text is not None:
+        first_point = text.text_point(first_row)
+    else:
+        first_point = view.text_point(first_row, 0)
     # last_point = view.text_point(last_row + 1, 0)
     view.sel().clear()
     view.sel().add(sublime.Region(first_point))
@@ -279,55 +495,57 @@ def show_rows(view, first_row, last_row):
 
 
 class InsertAtCommand(sublime_plugin.TextCommand):
-    """Like the insert command, but insert at a specific point."""
-    def run(self, edit, point, string):
+    """Like the insert command, but insert at a specific point.
+
+    If 'select' is true, also select the inserted text and scroll to it.
+    """
+    def run(self, edit, point, string, select=False):
         view = self.view
-        view.insert(edit, point, string)
+        size = view.insert(edit, point, string)
+        if select:
+            view.sel().clear()
+            view.sel().add(sublime.Region(point, point + size))
+            view.show(sublime.Region(point, point))
 
 
-def insert_rows(view, row, content, margin=2):
-    point = view.text_point(row, 0)
+def insert_rows(view, row, content, margin=2, text=None):
+    if text is None:
+        text = view_text(view)
+    point = text.text_point(row)
 
     if margin:
         if row > 0:
             # Add blank lines before.
-            region = sublime.Region(max(0, point - margin - 1), point)
-            text_before = view.substr(region)
-            blanks = 0
-            for c in reversed(text_before):
-                if c == '\n':
-                    blanks += 1
-                else:
-                    break
+            blanks = text.newlines_before(point, margin + 1)
             if blanks < margin + 1:
                 content = '\n' * (margin + 1 - blanks) + content
 
-        if point < view.size() - 1:
+        if point < text.size() - 1:
             # Add blank lines after.
-            region = sublime.Region(point, min(view.size(), point + margin))
-            text_after = view.substr(region)
-            blanks = 0
-            for c in text_after:
-                if c == '\n':
-                    blanks += 1
-                else:
-                    break
+            blanks = text.newlines_after(point, margin)
             if blanks < margin:
                 content = content + '\n' * (margin - blanks)
 
-    view.run_command('insert_at', {'point': point, 'string': content})
-    view.sel().clear()
-    region = sublime.Region(point, point + len(content))
-    view.sel().add(region)
-    view.show(sublime.Region(point, point))
+    view.run_command('insert_at', {'point': point,
+                                   'string': content,
+                                   'select': True})
 
 
 class CodeNavigator(object):
     """Base class for navigating within a particular file."""
-    def __init__(self, target_filename, source_filename, content, source_row):
+    def __init__(self, target_filename, source_filename, content, source_row,
+                 related=False):
         self.target_filename = target_filename
-        self.source_decls = list_decls(content, source_filename)
-        self.source_decl = find_decl_for_row(self.source_decls, source_row)
+        self.source_filename = source_filename
+        self.related = related
+        # The source decls are frozen once here so that the navigator
+        # never holds on to a mutable Decl tree. Freezing against the
+        # previous snapshot of the file reuses its unchanged subtrees.
+        previous = _snapshots.get(source_filename, ())
+        self.source_decls = list_decl_snapshots(content, source_filename,
+                                                previous)
+        _snapshots[source_filename] = self.source_decls
+        self.source_path = find_path_for_row(self.source_decls, source_row)
 
         basename = os.path.basename(source_filename)
         relmodule, _ext = os.path.splitext(basename)
@@ -344,20 +562,24 @@ class CodeNavigator(object):
                  source_decls=None,
                  target_decls=None,
                  parent_target_decl=None,
-                 match_mode='exact'):
+                 match_mode='exact',
+                 text=None):
         """Get the rows in the target view that correlate with a source name.
 
         This can traverse either top-level names or names inside a class.
         If source_decls and target_decls are not given, traverse the top-level
-        names.
+        names. If text (a ViewText of the target view) is not given, read it
+        from the target view.
 
         Returns (target_decl or None, first_row, last_row). When not found,
         'first_row' indicates where the declaration should exist.
         """
         if source_decls is None:
             source_decls = self.source_decls
+        if text is None:
+            text = view_text(target_view)
         if target_decls is None:
-            target_decls = list_view_decls(target_view)
+            target_decls = list_decls(text.content, target_view.file_name())
 
         target_name = convert_name(source_name)
         target_decl_map = dict((decl.name, decl) for decl in target_decls)
@@ -400,7 +622,7 @@ class CodeNavigator(object):
                 row = parent_target_decl.last_row + 1
             else:
                 # Add the new code to the end of the file.
-                row, _col = target_view.rowcol(target_view.size())
+                row = text.last_row()
 
         return None, row, row
 
@@ -435,66 +657,90 @@ class TestCodeNavigator(CodeNavigator):
         self.generate = generate
 
     def goto(self, target_view):
-        if self.source_decl is None:
-            return
-
-        decls = self.source_decl.get_path()
+        decls = self.source_path
         if not decls:
             # No particular declaration was specified.
             return
 
+        if self.related:
+            self.goto_related(target_view, decls)
+            return
+
         name = decls[0].name
         self.template_vars['name'] = name
         self.template_vars['testname'] = self.testgen.to_test_class_name(name)
 
-        if self.generate and not target_view.size():
+        text = view_text(target_view)
+        if self.generate and not text.size():
             # The test module is empty or doesn't exist, so create it.
             content = self.testgen.make_test_head(self.template_vars)
-            insert_rows(target_view, 0, content)
+            insert_rows(target_view, 0, content, text=text)
+            text = view_text(target_view)
 
         try:
-            if isinstance(decls[0], ClassDecl):
-                if len(decls) >= 2 and isinstance(decls[1], FuncDecl):
-                    self.goto_method(target_view, decls[0], decls[1])
+            if decls[0].kind is ClassDecl:
+                if len(decls) >= 2 and decls[1].kind is FuncDecl:
+                    self.goto_method(target_view, text, decls[0], decls[1])
                 else:
-                    self.goto_class(target_view, decls[0])
-            elif isinstance(decls[0], FuncDecl):
-                self.goto_func(target_view, decls[0])
+                    self.goto_class(target_view, text, decls[0])
+            elif decls[0].kind is FuncDecl:
+                self.goto_func(target_view, text, decls[0])
+        except SyntaxError as e:
+            show_syntax_error(e)
+            return
+
+    def goto_related(self, target_view, decls):
+        try:
+            index = DeclNameIndex(list_view_decls(target_view))
         except SyntaxError as e:
             show_syntax_error(e)
             return
 
-    def goto_class(self, target_view, class_decl):
+        # Like traverse, match test classes exactly and test methods by
+        # prefix, so Test_foo_bar (the test of foo_bar) is not related to foo.
+        class_name = self.testgen.to_test_class_name(decls[0].name)
+        matches = index.exact(class_name)
+
+        if (decls[0].kind is ClassDecl and len(decls) >= 2 and
+                decls[1].kind is FuncDecl):
+            method_name = self.testgen.to_test_method_name(decls[1].name)
+            matches = index.prefix_under(class_name + '.' + method_name)
+
+        show_related(target_view, matches)
+
+    def goto_class(self, target_view, text, class_decl):
         sublime.status_message("SublimePythonGotoTest: "
                                "goto_class {0}".format(class_decl.name))
 
         convert_name = self.testgen.to_test_class_name
         target_decl, f_row, l_row = self.traverse(target_view,
                                                   class_decl.name,
-                                                  convert_name)
+                                                  convert_name,
+                                                  text=text)
 
         if target_decl is None and self.generate:
             content = self.testgen.make_class_test(self.template_vars)
-            insert_rows(target_view, f_row, content)
+            insert_rows(target_view, f_row, content, text=text)
         else:
-            show_rows(target_view, f_row, l_row)
+            show_rows(target_view, f_row, l_row, text=text)
 
-    def goto_func(self, target_view, func_decl):
+    def goto_func(self, target_view, text, func_decl):
         sublime.status_message("SublimePythonGotoTest: "
                                "goto_func {0}".format(func_decl.name))
 
         convert_name = self.testgen.to_test_class_name
         target_decl, f_row, l_row = self.traverse(target_view,
                                                   func_decl.name,
-                                                  convert_name)
+                                                  convert_name,
+                                                  text=text)
 
         if target_decl is None and self.generate:
             content = self.testgen.make_function_test(self.template_vars)
-            insert_rows(target_view, f_row + 1, content)
+            insert_rows(target_view, f_row + 1, content, text=text)
         else:
-            show_rows(target_view, f_row, l_row)
+            show_rows(target_view, f_row, l_row, text=text)
 
-    def goto_method(self, target_view, class_decl, method_decl):
+    def goto_method(self, target_view, text, class_decl, method_decl):
         sublime.status_message("SublimePythonGotoTest: "
                                "goto_method {0}.{1}".format(class_decl.name,
                                                             method_decl.name))
@@ -502,16 +748,19 @@ class TestCodeNavigator(CodeNavigator):
         convert_name = self.testgen.to_test_class_name
         target_class_decl, f_row, l_row = self.traverse(target_view,
                                                         class_decl.name,
-                                                        convert_name)
+                                                        convert_name,
+                                                        text=text)
 
         if target_class_decl is None and self.generate:
             content = self.testgen.make_class_test(self.template_vars)
-            insert_rows(target_view, f_row, content)
+            insert_rows(target_view, f_row, content, text=text)
 
             # Re-read the declarations.
+            text = view_text(target_view)
             tup = self.traverse(target_view,
                                 class_decl.name,
-                                convert_name)
+                                convert_name,
+                                text=text)
             target_class_decl, f_row, l_row = tup
 
         if target_class_decl is not None:
@@ -521,7 +770,8 @@ class TestCodeNavigator(CodeNavigator):
                                 source_decls=class_decl.children,
                                 target_decls=target_class_decl.children,
                                 parent_target_decl=target_class_decl,
-                                match_mode='prefix_under')
+                                match_mode='prefix_under',
+                                text=text)
             target_method_decl, f_row, l_row = tup
 
             if target_method_decl is None and self.generate:
@@ -532,15 +782,46 @@ class TestCodeNavigator(CodeNavigator):
                     self.testgen.to_test_method_name(method_decl.name)
                 template_vars['classname'] = class_decl.name
                 content = self.testgen.make_method_test(template_vars)
-                insert_rows(target_view, f_row, content, margin=1)
+                insert_rows(target_view, f_row, content, margin=1, text=text)
                 return
 
-        show_rows(target_view, f_row, l_row)
+        show_rows(target_view, f_row, l_row, text=text)
 
 
 class MainCodeNavigator(CodeNavigator):
     def goto(self, target_view):
-        pass
+        decls = self.source_path
+        if not self.related or not decls:
+            return
+
+        # Index the main code by the names its tests would have, then look
+        # up the test name and its prefixes.
+        testgen = CustomTestGenerator(self.source_filename)
+        try:
+            index = DeclNameIndex(list_view_decls(target_view),
+                                  to_class_name=testgen.to_test_class_name,
+                                  to_method_name=testgen.to_test_method_name)
+        except SyntaxError as e:
+            show_syntax_error(e)
+            return
+
+        # Only prefixes of the method name are related; prefixes of the
+        # test class name would name other classes or functions.
+        class_name = decls[0].name
+        name = '.'.join(decl.name for decl in decls[:2])
+        matches = [('.'.join(d.name for d in decl.get_path()), decl)
+                   for key, decl in index.related(name)
+                   if key == class_name or key.startswith(class_name + '.')]
+        show_related(target_view, matches)
+
+
+def file_stamp(fn):
+    """Identify a version of a file by its modification time and size.
+
+    The size catches changes within the mtime resolution of the filesystem.
+    """
+    st = os.stat(fn)
+    return getattr(st, 'st_mtime_ns', st.st_mtime), st.st_size
 
 
 class CustomTestGenerator(object):
@@ -570,17 +851,47 @@ class CustomTestGenerator(object):
             else:
                 parent = next_parent
 
-        funcs = {}
+        # Reuse the functions from a previous execution of the same
+        # chain of modules as long as none of them have changed.
+        key = tuple(modfiles)
+        stamps = tuple(file_stamp(modfile) for modfile in modfiles)
+        cached = _testgen_cache.get(key)
+        if cached is not None and cached[0] == stamps:
+            funcs = cached[1]
+        else:
+            namespace = {}
+
+            # Execute the most generic testgen module first so that more
+            # specific modules can override as they see fit.
+            for modfile in modfiles:
+                execfile(modfile, namespace, namespace)
 
-        # Execute the most generic testgen module first so that more
-        # specific modules can override as they see fit.
-        for modfile in modfiles:
-            execfile(modfile, funcs, funcs)
+            funcs = dict((func_name, namespace[func_name])
+                         for func_name in self.func_names)
+            # Replace any stale entry for this chain.
+            _testgen_cache[key] = (stamps, funcs)
 
         # Now add the functions as methods of this object.
         for func_name in self.func_names:
             setattr(self, func_name, funcs[func_name])
 
+        self.makers = {
+            'test_head': funcs['make_test_head'],
+            'function_test': funcs['make_function_test'],
+            'class_test': funcs['make_class_test'],
+            'method_test': funcs['make_method_test'],
+        }
+
+    def render(self, stubs, separator='\n\n'):
+        """Render a list of (kind, template_vars) stubs as one text block.
+
+        'kind' is 'test_head', 'function_test', 'class_test' or
+        'method_test' and selects the corresponding make_* function.
+        """
+        makers = self.makers
+        return separator.join([makers[kind](template_vars)
+                               for kind, template_vars in stubs])
+
 
 def test_list_decls():
     # Ensure list_decls doesn't trip over various odd cases.
@@ -635,5 +946,279 @@ def test_list_decls():
     assert decls[3].last_row == 16
 
 
+def test_list_decls_async():
+    content = ("async def foo():\n"        # row 0
+               "    pass\n"                # row 1
+               "class A:\n"                # row 2
+               "    async def m(self):\n"  # row 3
+               "        pass\n")           # row 4
+    decls = list_decls(content, 'async_test')
+    assert [decl.name for decl in decls] == ['foo', 'A']
+    assert isinstance(decls[0], FuncDecl)
+    assert (decls[0].first_row, decls[0].last_row) == (0, 1)
+    assert [decl.name for decl in decls[1].children] == ['m']
+    assert (decls[1].first_row, decls[1].last_row) == (2, 4)
+
+
+def test_code_navigator_reuses_snapshot():
+    content = ("class A:\n"
+               "    def f(self):\n"
+               "        pass\n"
+               "\n"
+               "def g():\n"
+               "    pass\n")
+    kw = {'target_filename': '/nonexistent/tests/test_reuse.py',
+          'source_filename': '/nonexistent/reuse.py',
+          'source_row': 1}
+    _snapshots.pop(kw['source_filename'], None)
+    old = CodeNavigator(content=content, **kw).source_decls
+    new = CodeNavigator(content=content + "\n\ndef h():\n    pass\n",
+                        **kw).source_decls
+    assert new is not old
+    assert new[0] is old[0]
+    assert _snapshots[kw['source_filename']] is new
+    del _snapshots[kw['source_filename']]
+
+
+def test_freeze_decls():
+    content = ("class A:\n"          # row 0
+               "    def f(self):\n"  # row 1
+               "        pass\n"      # row 2
+               "\n"                  # row 3
+               "def g():\n"          # row 4
+               "    pass\n")         # row 5
+    old = list_decl_snapshots(content, 'freeze_test')
+    assert len(old) == 2
+    assert old[0].kind is ClassDecl
+    assert old[0].name == 'A'
+    assert (old[0].first_row, old[0].last_row) == (0, 2)
+    assert old[0].children[0].kind is FuncDecl
+    assert old[0].children[0].name == 'f'
+    assert old[1].name == 'g'
+    assert (old[1].first_row, old[1].last_row) == (4, 5)
+    # Snapshots are immutable.
+    try:
+        old[0].name = 'B'
+    except AttributeError:
+        pass
+    else:
+        raise AssertionError("DeclSnapshot should be immutable")
+
+    # Unchanged subtrees are shared with the previous snapshot.
+    content2 = content + "\n\ndef h():\n    pass\n"
+    new = list_decl_snapshots(content2, 'freeze_test', previous=old)
+    assert len(new) == 3
+    assert new[0] is old[0]
+    assert new[0].children is old[0].children
+    assert new[2].name == 'h'
+    assert find_decl_for_row(new, 2) is old[0].children[0]
+    assert find_path_for_row(new, 2) == [old[0], old[0].children[0]]
+    assert find_path_for_row(new, 0) == [old[0]]
+    assert find_path_for_row(new, 20) == []
+
+
+def test_decl_name_index():
+    content = ("class TestFoo:\n"
+               "    def test_bar(self): pass\n"
+               "    def test_bar_raises(self): pass\n"
+               "    def test_bar_empty(self): pass\n"
+               "    def test_barn(self): pass\n"
+               "class TestFoo_other:\n"
+               "    def test_x(self): pass\n"
+               "class TestFoobar: pass\n"
+               "def test_foo(): pass\n")
+    index = DeclNameIndex(list_decls(content, 'index_test'))
+    names = [name for name, _decl in index.prefix_under('TestFoo')]
+    assert names == ['TestFoo', 'TestFoo_other']
+    names = [name for name, _decl in index.prefix_under('TestFoo.test_bar')]
+    assert names == ['TestFoo.test_bar',
+                     'TestFoo.test_bar_empty',
+                     'TestFoo.test_bar_raises']
+    assert index.prefix_under('TestBaz') == []
+
+    content = ("class Foo:\n"
+               "    def bar(self): pass\n"
+               "    def __init__(self): pass\n"
+               "def foo(): pass\n")
+    testgen = CustomTestGenerator(__file__)
+    index = DeclNameIndex(list_decls(content, 'index_test'),
+                          to_class_name=testgen.to_test_class_name,
+                          to_method_name=testgen.to_test_method_name)
+    matches = index.related('TestFoo.test_bar_raises')
+    assert [decl.name for _key, decl in matches] == ['bar', 'Foo']
+    matches = index.related('TestFoo.test_ctor')
+    assert [decl.name for _key, decl in matches] == ['__init__', 'Foo']
+    matches = index.related('Test_foo.test_it')
+    assert [decl.name for _key, decl in matches] == ['foo']
+
+
+def test_custom_test_generator_render():
+    testgen = CustomTestGenerator(__file__)
+    # The chain of testgen modules is executed only once.
+    assert (CustomTestGenerator(__file__).make_class_test is
+            testgen.make_class_test)
+
+    template_vars = {'source_filename': 'foo.py',
+                     'relmodule': 'foo',
+                     'name': 'Foo',
+                     'testname': 'TestFoo'}
+    method_vars = dict(template_vars,
+                       name='bar',
+                       testname='test_bar',
+                       classname='Foo')
+    text = testgen.render([('class_test', template_vars),
+                           ('method_test', method_vars)],
+                          separator='\n')
+    assert text == (testgen.make_class_test(template_vars) + '\n' +
+                    testgen.make_method_test(method_vars))
+    assert 'class TestFoo(unittest.TestCase):' in text
+    assert '        obj.bar()\n' in text
+    assert testgen.render([]) == ''
+
+    # A changed module replaces the cached entry for its chain.
+    _testgen_cache.clear()
+    CustomTestGenerator(__file__)
+    [(key, (stamps, funcs))] = _testgen_cache.items()
+    # Same mtimes but different sizes, as after two saves in one second.
+    changed = tuple((mtime, size + 1) for mtime, size in stamps)
+    _testgen_cache[key] = (changed, funcs)
+    testgen = CustomTestGenerator(__file__)
+    assert list(_testgen_cache) == [key]
+    assert _testgen_cache[key][0] == stamps
+    assert testgen.make_class_test is not funcs['make_class_test']
+
+
+def test_view_text():
+    content = ("a\n"    # row 0
+               "\n"     # row 1
+               "\n"     # row 2
+               "bc\n"   # row 3
+               "d")     # row 4
+    text = ViewText(content)
+    assert list(text.line_starts) == [0, 2, 3, 4, 7]
+    assert text.size() == 8
+    assert text.last_row() == 4
+    assert text.text_point(0) == 0
+    assert text.text_point(3) == 4
+    assert text.text_point(5) == 8
+    assert text.newlines_before(4, 5) == 3
+    assert text.newlines_before(4, 2) == 2
+    assert text.newlines_before(0, 3) == 0
+    assert text.newlines_after(1, 5) == 3
+    assert text.newlines_after(2, 1) == 1
+    assert text.newlines_after(8, 2) == 0
+
+    text = ViewText('')
+    assert text.last_row() == 0
+    assert text.text_point(0) == 0
+    assert text.text_point(3) == 0
+
+
+class _StubView(object):
+    """Just enough of a view and its window for the goto_related tests."""
+
+    def __init__(self, filename, content):
+        self.filename = filename
+        self.content = content
+        self.panel_items = None
+        self.status = None
+
+    def file_name(self):
+        return self.filename
+
+    def size(self):
+        return len(self.content)
+
+    def substr(self, region):
+        return self.content
+
+    def window(self):
+        return self
+
+    def show_quick_panel(self, items, on_done):
+        self.panel_items = items
+
+
+def test_goto_related_tests():
+    source = ("def foo():\n"               # row 0
+              "    pass\n"                 # row 1
+              "def foo_bar():\n"           # row 2
+              "    pass\n"                 # row 3
+              "class Foo:\n"               # row 4
+              "    def bar(self): pass\n"  # row 5
+              "    def baz(self): pass\n")  # row 6
+    tests = ("class Test_foo:\n"
+             "    def test_it(self): pass\n"
+             "class Test_foo_bar:\n"
+             "    def test_it(self): pass\n"
+             "class TestFoo:\n"
+             "    def test_bar(self): pass\n"
+             "    def test_bar_raises(self): pass\n"
+             "    def test_baz(self): pass\n"
+             "class TestFoo_other:\n"
+             "    def test_bar(self): pass\n")
+
+    def panel_names(row, content=tests):
+        nav = TestCodeNavigator(generate=False,
+                                related=True,
+                                target_filename='/nonexistent/tests/test_m.py',
+                                source_filename='/nonexistent/m.py',
+                                content=source,
+                                source_row=row)
+        view = _StubView('/nonexistent/tests/test_m.py', content)
+        nav.goto(view)
+        if view.panel_items is None:
+            return None
+        return [name for name, _line in view.panel_items]
+
+    assert panel_names(0) == ['Test_foo']
+    assert panel_names(2) == ['Test_foo_bar']
+    assert panel_names(4) == ['TestFoo']
+    assert panel_names(5) == ['TestFoo.test_bar', 'TestFoo.test_bar_raises']
+    assert panel_names(6) == ['TestFoo.test_baz']
+    assert panel_names(0, content='class (:\n') is None
+
+
+def test_goto_related_code():
+    tests = ("class Test_foo:\n"                     # row 0
+             "    def test_it(self): pass\n"         # row 1
+             "class Test_foo_bar:\n"                 # row 2
+             "    def test_it(self): pass\n"         # row 3
+             "class TestFoo:\n"                      # row 4
+             "    def test_bar_raises(self): pass\n")  # row 5
+    source = ("def foo():\n"
+              "    pass\n"
+              "def foo_bar():\n"
+              "    pass\n"
+              "class Foo:\n"
+              "    def bar(self): pass\n")
+
+    def panel_names(row, content=source):
+        nav = MainCodeNavigator(related=True,
+                                target_filename='/nonexistent/m.py',
+                                source_filename='/nonexistent/tests/test_m.py',
+                                content=tests,
+                                source_row=row)
+        view = _StubView('/nonexistent/m.py', content)
+        nav.goto(view)
+        if view.panel_items is None:
+            return None
+        return [name for name, _line in view.panel_items]
+
+    assert panel_names(1) == ['foo']
+    assert panel_names(3) == ['foo_bar']
+    assert panel_names(4) == ['Foo']
+    assert panel_names(5) == ['Foo.bar', 'Foo']
+    assert panel_names(1, content='def (:\n') is None
+
+
 if __name__ == '__main__':
     test_list_decls()
+    test_list_decls_async()
+    test_freeze_decls()
+    test_code_navigator_reuses_snapshot()
+    test_decl_name_index()
+    test_goto_related_tests()
+    test_goto_related_code()
+    test_custom_test_generator_render()
+    test_view_text()
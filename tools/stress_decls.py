@@ -0,0 +1,379 @@
+"""
+Stress and equivalence harness for the declaration parsers in gototest.py.
+
+Runs headless (outside Sublime Text) over the standard library and a
+generated corpus, and checks every alternative Decl-producing path against
+the reference Visitor row by row:
+
+    - snapshot: freeze_decls(), the immutable DeclSnapshot trees.
+
+    - incremental: freeze_decls() given the snapshot from before a random
+      edit, which must equal a fresh snapshot of the edited module and
+      must reuse every unchanged subtree by identity.
+
+    - name_index: DeclNameIndex.prefix_under(), which must agree with
+      CodeNavigator.filter_targets(mode='prefix_under').
+
+    - view_text: ViewText.text_point(), which must agree with a naive
+      split of the content into lines.
+
+Usage:
+
+    python tools/stress_decls.py [--stdlib-limit N] [--generated N]
+                                 [--edits N] [--seed N]
+
+Sublime Text loads only the top-level modules of a package as plugins, so
+it does not load this script from the tools subdirectory.
+
+Throughput is measured for each engine call alone, on a module that the
+reference visitor has already parsed.
+"""
+
+import argparse
+import ast
+import os
+import random
+import sys
+import time
+import tokenize
+import types
+
+
+here = os.path.abspath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+try:
+    import sublime  # noqa: F401
+except ImportError:
+    # Running headless. gototest only needs these modules to define its
+    # commands, so empty stand-ins are enough to import it.
+    sublime = types.ModuleType('sublime')
+    sublime_plugin = types.ModuleType('sublime_plugin')
+    sublime_plugin.TextCommand = object
+    sublime_plugin.EventListener = object
+    sys.modules['sublime'] = sublime
+    sys.modules['sublime_plugin'] = sublime_plugin
+
+import gototest  # noqa: E402
+
+
+class Mismatch(Exception):
+    """An alternative engine disagreed with the reference visitor."""
+
+
+class Stats(object):
+    """Accumulate time and line counts for each engine."""
+
+    def __init__(self):
+        self.seconds = {}
+        self.lines = {}
+        self.reused = 0
+        self.rebuilt = 0
+
+    def timed(self, engine, lines, func, *args):
+        start = time.time()
+        result = func(*args)
+        elapsed = time.time() - start
+        self.seconds[engine] = self.seconds.get(engine, 0.0) + elapsed
+        self.lines[engine] = self.lines.get(engine, 0) + lines
+        return result
+
+    def report(self, out=sys.stdout):
+        for engine in sorted(self.seconds):
+            seconds = self.seconds[engine]
+            lines = self.lines[engine]
+            rate = lines / seconds if seconds else float('inf')
+            out.write('{0:<12} {1:>10} lines {2:>9.3f}s {3:>12.0f} lines/s\n'
+                      .format(engine, lines, seconds, rate))
+        out.write('incremental reused {0} of {1} subtrees\n'
+                  .format(self.reused, self.reused + self.rebuilt))
+
+
+def kind_name(decl):
+    if isinstance(decl, gototest.DeclSnapshot):
+        return decl.kind.__name__
+    return decl.__class__.__name__
+
+
+def row_paths(decls, row_count):
+    """List the path of (kind, name, first_row, last_row) for every row."""
+    paths = []
+    for row in range(row_count):
+        path = []
+        children = decls
+        while True:
+            for decl in children:
+                if decl.first_row <= row <= decl.last_row:
+                    path.append((kind_name(decl), decl.name,
+                                 decl.first_row, decl.last_row))
+                    children = decl.children
+                    break
+            else:
+                break
+        paths.append(tuple(path))
+    return paths
+
+
+def compare_rows(label, engine, expect, actual):
+    for row, (e, a) in enumerate(zip(expect, actual)):
+        if e != a:
+            raise Mismatch('{0}: {1} differs at row {2}:\n  reference: {3}\n'
+                           '  {1}: {4}'.format(label, engine, row, e, a))
+    if len(expect) != len(actual):
+        raise Mismatch('{0}: {1} row count differs'.format(label, engine))
+
+
+def walk(decls):
+    """Yield every decl in a tree."""
+    stack = list(decls)
+    while stack:
+        decl = stack.pop()
+        yield decl
+        stack.extend(decl.children)
+
+
+decl_node_types = tuple(
+    getattr(ast, name) for name in ('FunctionDef', 'AsyncFunctionDef',
+                                    'ClassDef')
+    if hasattr(ast, name))
+
+
+def check_decl_count(label, content, decls):
+    """Check that every def, async def and class produced a decl."""
+    expect = sum(1 for node in ast.walk(ast.parse(content))
+                 if isinstance(node, decl_node_types))
+    actual = sum(1 for _decl in walk(decls))
+    if expect != actual:
+        raise Mismatch('{0}: reference found {1} decls, expected {2}'
+                       .format(label, actual, expect))
+
+
+def check_sharing(label, previous, snapshot, stats):
+    """Check that subtrees unchanged since 'previous' are the same objects."""
+    old = {}
+    for node in walk(previous):
+        old.setdefault(node, set()).add(id(node))
+    for node in walk(snapshot):
+        ids = old.get(node)
+        if ids is None:
+            stats.rebuilt += 1
+        elif id(node) in ids:
+            stats.reused += 1
+        else:
+            raise Mismatch('{0}: unchanged subtree {1!r} was rebuilt'
+                           .format(label, node.name))
+
+
+def name_scopes(decls):
+    return [decls] + [decl.children for decl in decls
+                      if isinstance(decl, gototest.ClassDecl)]
+
+
+def index_lookups(scopes):
+    """Index each scope and look up every name in it."""
+    results = []
+    for scope in scopes:
+        index = gototest.DeclNameIndex(scope)
+        for decl in scope:
+            results.append(index.prefix_under(decl.name))
+    return results
+
+
+def check_name_index(label, scopes, results):
+    """Compare DeclNameIndex.prefix_under with filter_targets."""
+    nav = gototest.CodeNavigator.__new__(gototest.CodeNavigator)
+    results = iter(results)
+    for scope in scopes:
+        decl_map = dict((decl.name, decl) for decl in scope)
+        for decl in scope:
+            expect = nav.filter_targets(decl_map, decl.name, 'prefix_under')
+            # The index keeps redefinitions of a name (such as property
+            # setters) while decl_map keeps only the last, so compare the
+            # distinct names.
+            actual = []
+            for key, _decl in next(results):
+                if key not in actual:
+                    actual.append(key)
+            if [d.name for d in expect] != actual:
+                raise Mismatch('{0}: name_index differs for {1!r}'
+                               .format(label, decl.name))
+
+
+def check_view_text(label, content, text):
+    lines = content.split('\n')
+    point = 0
+    for row, line in enumerate(lines):
+        if text.text_point(row) != point:
+            raise Mismatch('{0}: view_text differs at row {1}'
+                           .format(label, row))
+        point += len(line) + 1
+    if text.last_row() != len(lines) - 1:
+        raise Mismatch('{0}: view_text last_row differs'.format(label))
+
+
+def check_module(label, content, stats, previous=None):
+    """Check every engine against the reference visitor for one module.
+
+    Returns the snapshot of the module, or None if it does not parse.
+    """
+    lines = content.count('\n') + 1
+    try:
+        decls = stats.timed('visitor', lines,
+                            gototest.list_decls, content, label)
+    except (SyntaxError, ValueError):
+        return None
+
+    check_decl_count(label, content, decls)
+    expect = row_paths(decls, lines)
+
+    snapshot = stats.timed('snapshot', lines, gototest.freeze_decls, decls)
+    compare_rows(label, 'snapshot', expect, row_paths(snapshot, lines))
+
+    if previous is not None:
+        incremental = stats.timed('incremental', lines,
+                                  gototest.freeze_decls, decls, previous)
+        if incremental != snapshot:
+            raise Mismatch('{0}: incremental snapshot differs from a fresh '
+                           'snapshot'.format(label))
+        check_sharing(label, previous, incremental, stats)
+        compare_rows(label, 'incremental', expect,
+                     row_paths(incremental, lines))
+
+    scopes = name_scopes(decls)
+    results = stats.timed('name_index', lines, index_lookups, scopes)
+    check_name_index(label, scopes, results)
+
+    text = stats.timed('view_text', lines, gototest.ViewText, content)
+    check_view_text(label, content, text)
+    return snapshot
+
+
+def iter_stdlib(limit):
+    """Yield (filename, content) for modules in the standard library."""
+    root = os.path.dirname(os.__file__)
+    count = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if d != 'site-packages')
+        for fn in sorted(filenames):
+            if not fn.endswith('.py'):
+                continue
+            path = os.path.join(dirpath, fn)
+            try:
+                with tokenize.open(path) as f:
+                    content = f.read()
+            except (SyntaxError, UnicodeDecodeError, IOError):
+                continue
+            yield path, content
+            count += 1
+            if limit and count >= limit:
+                return
+
+
+def generate_block(rng, depth, indent):
+    """Generate a random block of declarations and statements."""
+    pad = ' ' * indent
+    out = []
+    for _i in range(rng.randint(1, 4)):
+        choice = rng.randint(0, 7 if depth < 3 else 3)
+        name = 'n{0}'.format(rng.randint(0, 20))
+        if choice == 0:
+            out.append('{0}x = 1\n'.format(pad))
+        elif choice == 1:
+            out.append('{0}s = """multi\n\nline {1}\n"""\n'.format(pad, name))
+        elif choice == 2:
+            out.append('{0}y = (1 +\n{0}     2) \\\n{0}    + 3\n'.format(pad))
+        elif choice == 3:
+            out.append('{0}pass  # comment\n\n'.format(pad))
+        elif choice in (4, 5):
+            if rng.random() < 0.3:
+                out.append('{0}@decorator(\n{0}    arg)\n'.format(pad))
+            prefix = 'async ' if rng.random() < 0.2 else ''
+            out.append('{0}{1}def {2}(a,\n{0}        b=[\n{0}  1]):\n'
+                       .format(pad, prefix, name))
+            out.extend(generate_block(rng, depth + 1, indent + 4))
+        else:
+            if rng.random() < 0.3:
+                out.append('{0}@decorator\n'.format(pad))
+            out.append('{0}class {1}(object):\n'.format(pad, name.upper()))
+            out.extend(generate_block(rng, depth + 1, indent + 4))
+        if rng.random() < 0.3:
+            out.append('\n' * rng.randint(1, 3))
+    return out
+
+
+def generate_module(rng):
+    return ''.join(generate_block(rng, 0, 0))
+
+
+def random_edit(rng, content, attempts=10):
+    """Apply a random line-based edit that keeps the module parseable.
+
+    Returns the original content if no attempt produced a valid module.
+    """
+    lines = content.splitlines(True)
+    for _i in range(attempts):
+        edited = list(lines)
+        pos = rng.randint(0, len(edited))
+        action = rng.randint(0, 2)
+        if action == 0:
+            # Insert a block indented like the line it displaces.
+            line = edited[pos] if pos < len(edited) else ''
+            indent = len(line) - len(line.lstrip(' '))
+            edited[pos:pos] = generate_block(rng, 1, indent)
+        elif action == 1:
+            del edited[pos:pos + rng.randint(1, 5)]
+        else:
+            edited[pos:pos] = ['\n'] * rng.randint(1, 3)
+        edited = ''.join(edited)
+        try:
+            ast.parse(edited)
+        except SyntaxError:
+            continue
+        return edited
+    return content
+
+
+def replay_edits(label, content, edits, rng, stats):
+    previous = check_module(label, content, stats)
+    for i in range(edits):
+        content = random_edit(rng, content)
+        snapshot = check_module('{0} (edit {1})'.format(label, i),
+                                content, stats, previous=previous)
+        if snapshot is not None:
+            previous = snapshot
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--stdlib-limit', type=int, default=0,
+                        help='Maximum number of stdlib modules (0: all)')
+    parser.add_argument('--generated', type=int, default=200,
+                        help='Number of generated modules')
+    parser.add_argument('--edits', type=int, default=20,
+                        help='Random edits to replay per generated module')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    stats = Stats()
+    modules = 0
+    try:
+        for path, content in iter_stdlib(args.stdlib_limit):
+            if check_module(path, content, stats) is not None:
+                modules += 1
+        for i in range(args.generated):
+            replay_edits('generated {0}'.format(i), generate_module(rng),
+                         args.edits, rng, stats)
+            modules += 1
+    except Mismatch as e:
+        sys.stderr.write('MISMATCH: {0}\n'.format(e))
+        return 1
+
+    sys.stdout.write('Checked {0} modules with no mismatches.\n'
+                     .format(modules))
+    stats.report()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())